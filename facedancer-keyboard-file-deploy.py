@@ -83,8 +83,24 @@ codes_mapping[ord('>')] = bytes((KEY_SHIFT_MASK, 0, 0x37))
 codes_mapping[ord('/')] = bytes((KEY_DEFAULT_MASK, 0, 0x38))
 codes_mapping[ord('?')] = bytes((KEY_SHIFT_MASK, 0, 0x38))
 
+KEY_UP = bytes((KEY_DEFAULT_MASK, 0, 0x00))
+
+# Translate text into a block of concatenated <KEY DOWN>/<KEY UP> reports.
+# Runs in the worker processes, so it must stay a module level function.
+
+def encode_chunk(text):
+    return b''.join([codes_mapping[ord(c)] + KEY_UP for c in text])
+
+# Split large files into chunks of this many characters. Every character maps
+# to its own reports, so any character boundary is a safe place to split.
+
+CHUNK_SIZE = 1 << 16
+
 # Define USB interface and device.
 
+import collections
+import multiprocessing
+import os
 import sys
 
 if len(sys.argv) != 2:
@@ -133,37 +149,115 @@ class USBKeyboardInterface(USBInterface):
                 descriptors
         )
 
-        self.keys = []
+        # Queue of encoded report block sources in send order: iterators, or
+        # self.pending while a large file is being encoded.
+        self.blocks = collections.deque()
+        self.block = b''
+        self.offset = 0
+
+        # Worker pool, the text it is encoding and the chunks submitted to it
+        # but not yet sent, while a large file is being encoded.
+        self.pool = None
+        self.text = None
+        self.text_offset = 0
+        self.pending = None
 
         self.append_delay(100)
 
-        self.keys.append(bytes((KEY_CTRL_MASK | KEY_ALT_MASK, 0, ord('t') - ord('a') + 4))) # <CTRL-ALT-T>
-        self.keys.append(bytes((KEY_DEFAULT_MASK, 0, 0x00))) # <KEY UP>
+        self.append_reports(bytes((KEY_CTRL_MASK | KEY_ALT_MASK, 0, ord('t') - ord('a') + 4))) # <CTRL-ALT-T>
+        self.append_reports(KEY_UP)
 
         self.append_delay(100)
 
         with open(sys.argv[1]) as f:
             self.append_save_file(sys.argv[1], f.read())
 
+    def append_reports(self, data):
+        self.blocks.append(iter((data,)))
+
     def append_delay(self, length):
-        for i in range(length):
-            self.keys.append(bytes((KEY_DEFAULT_MASK, 0, 0x00)))
+        self.append_reports(KEY_UP * length)
 
     def append_string(self, s):
-        for c in s:
-            self.keys.append(codes_mapping[ord(c)])                 # <KEY DOWN>
-            self.keys.append(bytes((KEY_DEFAULT_MASK, 0, 0x00)))    # <KEY UP>
+        self.append_reports(encode_chunk(s))
+
+    def append_string_parallel(self, s):
+        # Encode chunks on all cores, keeping only a fixed window of them
+        # ahead of the USB loop. Each chunk sent submits the next one.
+        self.pool = multiprocessing.Pool()
+        self.text = s
+        self.text_offset = 0
+        self.pending = collections.deque()
+        for i in range(2 * (os.cpu_count() or 1)):
+            self.submit_chunk()
+        self.blocks.append(self.pending)
+
+    def submit_chunk(self):
+        if self.text_offset >= len(self.text):
+            return
+
+        chunk = self.text[self.text_offset:self.text_offset + CHUNK_SIZE]
+        self.text_offset += CHUNK_SIZE
+        self.pending.append(self.pool.apply_async(encode_chunk, (chunk,)))
+
+    def next_encoded(self):
+        if len(self.pending) == 0:
+            raise StopIteration
+
+        # Don't stall the service loop waiting for a chunk; send nothing this
+        # time and try again on the next poll.
+        if not self.pending[0].ready():
+            return None
+
+        block = self.pending.popleft().get()
+        self.submit_chunk()
+        return block
 
     def append_save_file(self, name, text):
+        # Fail before connecting rather than halfway through typing the file.
+        unknown = set(text) - set(map(chr, codes_mapping))
+        if unknown:
+            raise ValueError('{}: no key codes for characters {}'.format(
+                name, ' '.join(sorted(map(repr, unknown)))))
+
         self.append_string('cat > {} << EOL\n'.format(name))
-        self.append_string(text)
+        if len(text) > CHUNK_SIZE:
+            self.append_string_parallel(text)
+        else:
+            self.append_string(text)
         self.append_string('EOL\n')
 
+    def next_report(self):
+        while self.offset >= len(self.block):
+            if len(self.blocks) == 0:
+                return None
+
+            try:
+                if self.blocks[0] is self.pending:
+                    block = self.next_encoded()
+                    if block is None:
+                        return None
+                    self.block = block
+                else:
+                    self.block = next(self.blocks[0])
+                self.offset = 0
+            except StopIteration:
+                if self.blocks.popleft() is self.pending:
+                    self.pool.close()
+                    self.pool.join()
+                    self.pool = None
+                    self.text = None
+                    self.pending = None
+
+        data = self.block[self.offset:self.offset + 3]
+        self.offset += 3
+        return data
+
     def handle_buffer_available(self):
-        if len(self.keys) == 0:
+        data = self.next_report()
+        if data is None:
             return
 
-        data = self.keys.pop(0)
         self.endpoint.send(data)
 
 class USBKeyboardDevice(USBDevice):
@@ -195,18 +289,24 @@ class USBKeyboardDevice(USBDevice):
 
 # Run. Press CTRL+C to exit.
 
-from Facedancer import *
-from MAXUSBApp import *
+# The guard keeps worker processes from starting the device when they import
+# this script under the spawn start method.
+
+if __name__ == '__main__':
+    from Facedancer import *
+    from MAXUSBApp import *
 
-sp = GoodFETSerialPort()
-fd = Facedancer(sp, verbose=1)
-u = MAXUSBApp(fd, verbose=1)
+    sp = GoodFETSerialPort()
+    fd = Facedancer(sp, verbose=1)
+    u = MAXUSBApp(fd, verbose=1)
 
-d = USBKeyboardDevice(u, verbose=4)
+    d = USBKeyboardDevice(u, verbose=4)
 
-d.connect()
+    d.connect()
 
-try:
-    d.run()
-except KeyboardInterrupt:
-    d.disconnect()
+    try:
+        d.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        d.disconnect()